@@ -2,24 +2,30 @@
 import typer
 import typing
 import time
+import os
 import pathlib
 import json
 import subprocess
 import shlex
-import statistics
 import shutil
+import stat
+import functools
+import hashlib
+import contextlib
 
-from github import Github
 from dataclasses import dataclass, asdict
 from rich import print
 from rich.text import Text
 from rich.panel import Panel
-from rich.table import Table
-from rich.syntax import Syntax
-from rich.progress import track
+from rich.rule import Rule
+from rich.ansi import AnsiDecoder
 
 
 APP_NAME = "gcr"
+# seconds to trust the on-disk list of an assignment's repositories
+REPO_CACHE_TTL = 5 * 60
+# bytes of each file to display in show, unless --full is passed
+SHOW_MAX_BYTES = 64 * 1024
 
 # don't want to dump token to stdout
 app = typer.Typer(pretty_exceptions_show_locals=False)
@@ -37,22 +43,44 @@ class Config:
             path.mkdir()
         return path
 
-    def github_org(self):
+    @functools.cached_property
+    def github(self):
+        # PyGithub is slow to import, only load it for commands that need it
+        from github import Github
+
+        # one client per config so its HTTP session (and connections) is reused;
+        # larger pages mean fewer round-trips when listing big orgs
+        return Github(self.github_token, per_page=100)
+
+    @contextlib.contextmanager
+    def github_errors(self):
+        """exit with a message, not a traceback, if a GitHub API call fails"""
+        from github import BadCredentialsException, GithubException
+
         try:
-            return Github(self.github_token).get_organization(self.org_name)
-        except Exception as e:
+            yield
+        except BadCredentialsException as e:
             print(f"[red]Could not authenticate for github.com/{self.org_name}")
-            print(e)
-            exit(1)
+            print(Text(str(e)))
+            raise typer.Exit(code=1)
+        except GithubException as e:
+            print(f"[red]GitHub request failed for github.com/{self.org_name}")
+            print(Text(str(e)))
+            raise typer.Exit(code=1)
+
+    def github_org(self):
+        with self.github_errors():
+            return self.github.get_organization(self.org_name)
 
 
+@functools.lru_cache(maxsize=1)
 def load_config():
     app_dir = typer.get_app_dir(APP_NAME)
     config_path: pathlib.Path = pathlib.Path(app_dir) / "config.json"
     if not config_path.is_file():
         print(f"[red]Could not open '{config_path}', run '{APP_NAME} configure'")
-        exit(1)
-    data = json.load(config_path.open())
+        raise typer.Exit(code=1)
+    data = json.loads(config_path.read_text())
     return Config(**data)
 
 
@@ -60,34 +88,102 @@ def _get_local_dirs(assignment_name: str, student_name: typing.Optional[str] = N
     config = load_config()
     path = config.working_path()
     if not student_name:
-        dirs = list(path.glob(assignment_name + "-*"))
+        # scandir reuses the d_type from the directory listing, avoiding a stat each
+        prefix = assignment_name + "-"
+        dirs = sorted(
+            pathlib.Path(entry.path)
+            for entry in os.scandir(path)
+            if entry.name.startswith(prefix) and entry.is_dir(follow_symlinks=False)
+        )
     else:
         dirs = [path / (assignment_name + "-" + student_name)]
     return dirs
 
 
-def _force_color(command: list[str]) -> list[str]:
-    """a hack to work around subprocess.run losing color"""
+# git takes color config ahead of the subcommand, others take a flag at the end
+_GIT_COLOR = (
+    "-c",
+    "color.ui=always",
+    "-c",
+    "color.diff=always",
+    "-c",
+    "color.status=always",
+)
+_COLOR_FLAGS = {"pytest": ("--color=yes",)}
+
 
-    # special rules for git
+def _force_color(command: typing.Sequence[str]) -> typing.Tuple[str, ...]:
+    """a hack to work around subprocess.run losing color"""
+    command = tuple(command)
     if command[0] == "git":
-        return (
-            command[:1]
-            + [
-                "-c",
-                "color.ui=always",
-                "-c",
-                "color.diff=always",
-                "-c",
-                "color.status=always",
-            ]
-            + command[1:]
+        return command[:1] + _GIT_COLOR + command[1:]
+    return command + _COLOR_FLAGS.get(command[0], ())
+
+
+def _run_in_dir(command: typing.Sequence[str], sdir: pathlib.Path):
+    """run command within sdir, returning the dir & result"""
+    return sdir, subprocess.run(command, cwd=sdir, capture_output=True)
+
+
+def _check_in_dirs(
+    command: typing.Sequence[str],
+    dirs: typing.List[pathlib.Path],
+    jobs: int,
+    on_done: typing.Callable[[], None],
+):
+    """run command within each dir, at most jobs at once
+
+    returns (dir, returncode, elapsed time) tuples in the same order as dirs
+    """
+    import asyncio
+
+    async def check_one(sdir: pathlib.Path, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            start_time = time.time()
+            proc = await asyncio.create_subprocess_exec(
+                *command,
+                cwd=sdir,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            # only the exit status matters, so output isn't kept at all
+            await proc.wait()
+            elapsed_time = time.time() - start_time
+        on_done()
+        return sdir, proc.returncode, elapsed_time
+
+    async def check_all():
+        # made inside the loop, older pythons bind a semaphore to the current loop
+        semaphore = asyncio.Semaphore(jobs)
+        return await asyncio.gather(*(check_one(sdir, semaphore) for sdir in dirs))
+
+    return asyncio.run(check_all())
+
+
+def _find_repos(config: Config, assignment_name: str, refresh: bool = False):
+    """get [name, ssh_url] pairs for an assignment, using a short-lived cache"""
+    cache_path = config.working_path() / ".repo_cache.json"
+    key = f"{config.org_name}/{assignment_name}"
+    try:
+        cache = json.loads(cache_path.read_text())
+    except (OSError, ValueError):
+        cache = {}
+
+    entry = cache.get(key)
+    if entry and not refresh and time.time() - entry["time"] < REPO_CACHE_TTL:
+        return entry["repos"]
+
+    # search narrows server-side, but matches on words so prefix is checked here
+    prefix = assignment_name + "-"
+    # results are paginated lazily, so iterating can fail too
+    with config.github_errors():
+        results = config.github.search_repositories(
+            f"org:{config.org_name} {assignment_name} in:name"
         )
-    known_commands = {"pytest": "--color=yes"}
-    colorize = known_commands.get(command[0])
-    if colorize:
-        return command + [colorize]
-    return command
+        repos = [[r.name, r.ssh_url] for r in results if r.name.startswith(prefix)]
+    cache[key] = {"time": time.time(), "repos": repos}
+    cache_path.write_text(json.dumps(cache))
+    return repos
 
 
 @app.command()
@@ -95,32 +191,128 @@ def checkout(
     assignment_name: str,
     student_name: typing.Optional[str] = typer.Argument(None),
     all: bool = False,
+    jobs: int = typer.Option(8, "--jobs", "-j", min=1),
+    depth: typing.Optional[int] = typer.Option(None, min=1),
+    filter: typing.Optional[str] = None,
+    full_clone: bool = False,
+    refresh: bool = False,
 ):
     """checkout student repositories"""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
     config = load_config()
-    org = config.github_org()
     if (not student_name and not all) or (student_name and all):
         print("[red]must provide either student_name or explicitly pass --all")
-        exit(1)
+        raise typer.Exit(code=1)
+    elif full_clone and depth:
+        print("[red]--full-clone can't be combined with --depth")
+        raise typer.Exit(code=1)
     elif student_name:
-        repos = [org.get_repo(assignment_name + "-" + student_name)]
+        org = config.github_org()
+        with config.github_errors():
+            repo = org.get_repo(assignment_name + "-" + student_name)
+        repos = [[repo.name, repo.ssh_url]]
     else:
-        repos = [
-            r for r in org.get_repos() if r.name.startswith(assignment_name + "-")
-        ]
+        repos = _find_repos(config, assignment_name, refresh)
 
     working_path = config.working_path()
     exists = 0
     checked_out = 0
-    for repo in repos:
-        if (working_path / repo.name).exists():
+    to_clone = []
+    for name, url in repos:
+        if (working_path / name).exists():
             exists += 1
             continue
-        subprocess.run(["git", "clone", repo.ssh_url], cwd=working_path)
-        checked_out += 1
+        to_clone.append((name, url))
+
+    # grading usually only needs the tip of the default branch
+    clone_command = ["git", "clone"]
+    if not full_clone:
+        clone_command += ["--single-branch", f"--depth={depth or 1}"]
+    if filter:
+        # partial clone, e.g. blob:none fetches old file contents from the remote
+        # only when needed; most useful with --full-clone, since a shallow clone
+        # checks out (and so downloads) the tip's blobs anyway
+        clone_command.append(f"--filter={filter}")
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(
+                subprocess.run,
+                clone_command + [url],
+                cwd=working_path,
+                capture_output=True,
+            ): name
+            for name, url in to_clone
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            result = future.result()
+            if result.returncode == 0:
+                print(f"Cloned '{name}'")
+                checked_out += 1
+            else:
+                print(f"[red]Failed to clone '{name}'")
+                print(_to_text(result.stderr))
     print(f"[green]{checked_out} new repositories[/], {exists} already existed.")
 
 
+def _to_text(data: bytes) -> Text:
+    """decode subprocess output, only parsing ANSI codes if there are any"""
+    decoded = data.decode(errors="replace")
+    if b"\x1b" not in data:
+        # plain Text (not str) so that rich doesn't interpret [brackets] as markup
+        return Text(decoded)
+    return Text.from_ansi(decoded)
+
+
+def _print_result(
+    match: pathlib.Path,
+    result: subprocess.CompletedProcess,
+    errors_only: bool,
+    success_only: bool,
+    wait: bool,
+):
+    if (errors_only and result.returncode != 0) or (
+        success_only
+        and result.returncode == 0
+        or (not success_only and not errors_only)
+    ):
+        print(
+            Panel(
+                _to_text(result.stderr + result.stdout),
+                title=f"[bold white]{match.name}",
+                subtitle="press <Enter> to continue" if wait else "",
+            )
+        )
+        if wait:
+            typer.prompt("", show_default=False, default="y", prompt_suffix="")
+
+
+def _stream_in_dir(command: typing.Sequence[str], sdir: pathlib.Path, wait: bool):
+    """run command within sdir, printing output as it is produced"""
+    print(Rule(f"[bold white]{sdir.name}"))
+    proc = subprocess.Popen(
+        command, cwd=sdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    # one decoder for the whole stream, so a style left open carries over lines
+    decoder = AnsiDecoder()
+    for line in proc.stdout:
+        line = line.rstrip(b"\r\n")
+        if b"\x1b" not in line and not decoder.style:
+            print(Text(line.decode(errors="replace")))
+        else:
+            print(decoder.decode_line(line.decode(errors="replace")))
+    proc.wait()
+    if wait:
+        typer.prompt(
+            "press <Enter> to continue",
+            show_default=False,
+            default="y",
+            prompt_suffix="",
+        )
+
+
 @app.command()
 def run(
     assignment_name: str,
@@ -129,71 +321,80 @@ def run(
     errors_only: bool = False,
     success_only: bool = False,
     wait: bool = False,
+    jobs: int = typer.Option(os.cpu_count() or 1, "--jobs", "-j", min=1),
 ):
     """run a local command within each student repo"""
+    from concurrent.futures import ThreadPoolExecutor
+
     dirs = _get_local_dirs(assignment_name, student_name)
 
-    # break apart command for subprocess
-    command = shlex.split(command)
-    # TODO: consider disabling capture_output via flag (to avoid color loss)
-    capture_output = True
-    if capture_output:
-        command = _force_color(command)
-
-    for match in dirs:
-        if not capture_output:
-            print(f"[bold white]{match.name}")
-
-        result = subprocess.run(command, cwd=match, capture_output=True)
-
-        if (errors_only and result.returncode != 0) or (
-            success_only
-            and result.returncode == 0
-            or (not success_only and not errors_only)
-        ):
-            print(
-                Panel(
-                    Text.from_ansi(result.stderr.decode())
-                    + Text.from_ansi(result.stdout.decode()),
-                    title=f"[bold white]{match.name}",
-                    subtitle="press <Enter> to continue" if wait else "",
-                )
-            )
-            if wait:
-                typer.prompt("", show_default=False, default="y", prompt_suffix="")
+    # break apart command for subprocess, it is the same for every repo
+    command = _force_color(shlex.split(command))
+
+    # output can be streamed unless it needs filtering or would interleave
+    if not errors_only and not success_only and (wait or jobs == 1 or len(dirs) == 1):
+        for match in dirs:
+            _stream_in_dir(command, match, wait)
+        return
+
+    # when waiting, don't run the next repo's command until <Enter> is pressed
+    if wait:
+        for match in dirs:
+            match, result = _run_in_dir(command, match)
+            _print_result(match, result, errors_only, success_only, wait)
+        return
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(lambda d: _run_in_dir(command, d), dirs)
+        for match, result in results:
+            _print_result(match, result, errors_only, success_only, wait)
 
 
 @app.command()
 def check(
     assignment_name: str,
     command: str,
+    jobs: int = typer.Option(os.cpu_count() or 1, "--jobs", "-j", min=1),
 ):
     """run a local command within each student repo and aggregate output"""
+    from rich.table import Table
+    from rich.progress import Progress
+
     dirs = _get_local_dirs(assignment_name)
+    if not dirs:
+        print(f"[red]no local repositories for '{assignment_name}', run checkout")
+        raise typer.Exit(code=1)
 
     # break apart command for subprocess
     command_pieces = shlex.split(command)
 
     total_passing = 0
     total_failing = 0
-    times = []
+    tmin = float("inf")
+    tmax = 0.0
+    tsum = 0.0
 
     table = Table()
     table.add_column("student")
     table.add_column("success", justify="center")
     table.add_column("time")
 
-    for sdir in track(dirs, description=f"Running '{command}'..."):
-        start_time = time.time()
-        result = subprocess.run(command_pieces, cwd=sdir, capture_output=True)
-        elapsed_time = time.time() - start_time
-        success = result.returncode == 0
+    with Progress() as progress:
+        task = progress.add_task(f"Running '{command}'...", total=len(dirs))
+        results = _check_in_dirs(
+            command_pieces, dirs, jobs, lambda: progress.advance(task)
+        )
+
+    for sdir, returncode, elapsed_time in results:
+        success = returncode == 0
 
         if success:
             total_passing += 1
         else:
             total_failing += 1
-        times.append(elapsed_time)
+        tmin = elapsed_time if elapsed_time < tmin else tmin
+        tmax = elapsed_time if elapsed_time > tmax else tmax
+        tsum += elapsed_time
 
         table.add_row(
             ("[green]" if success else "[red]") + sdir.name,
@@ -207,9 +408,9 @@ def check(
     grid.add_row("[blue]Command", "  " + command)  # a bit of padding for command
     grid.add_row("[green]Total Passing", str(total_passing))
     grid.add_row("[red]Total Failing", str(total_failing))
-    grid.add_row("[bold white]Min Time", f"{min(times):.2f}s")
-    grid.add_row("[bold white]Max Time", f"{max(times):.2f}s")
-    grid.add_row("[bold white]Average Time", f"{statistics.mean(times):.2f}s")
+    grid.add_row("[bold white]Min Time", f"{tmin:.2f}s")
+    grid.add_row("[bold white]Max Time", f"{tmax:.2f}s")
+    grid.add_row("[bold white]Average Time", f"{tsum / len(dirs):.2f}s")
 
     print(table)
     print(Panel.fit(grid, title="[bold white]Statistics"))
@@ -221,30 +422,73 @@ def show(
     filename: str,
     student_name: typing.Optional[str] = typer.Argument(None),
     wait: bool = False,
+    full: bool = False,
 ):
     """view a file for each student repo"""
+    from rich.syntax import Syntax
+
     dirs = _get_local_dirs(assignment_name, student_name)
+    # files share a name, so the lexer is guessed once, from the first file read
+    lexer = None
     for path in dirs:
+        title = f"[bold white]{path.name}/{filename}"
+        # one missing or unreadable submission shouldn't stop the rest
+        try:
+            with open(path / filename, "rb") as f:
+                data = f.read(-1 if full else SHOW_MAX_BYTES + 1)
+        except OSError as e:
+            print(Panel(Text(str(e), style="red"), title=title))
+            continue
+        notes = []
+        if len(data) > SHOW_MAX_BYTES and not full:
+            data = data[:SHOW_MAX_BYTES]
+            notes.append("truncated, pass --full to see all")
+        if wait:
+            notes.append("press <Enter> to continue")
+        code = data.decode("utf-8", errors="replace")
+        if lexer is None:
+            # contents matter for files without an extension, e.g. shebang scripts
+            lexer = Syntax.guess_lexer(str(path / filename), code)
         print(
             Panel(
-                Syntax.from_path(path / filename),
-                title=f"[bold white]{path.name}/{filename}",
-                subtitle="press <Enter> to continue" if wait else "",
+                Syntax(code, lexer),
+                title=title,
+                subtitle=" | ".join(notes),
             )
         )
         if wait:
             typer.prompt("", show_default=False, default="y", prompt_suffix="")
 
 
+def _copy_if_changed(newfile: pathlib.Path, digest: bytes, target: pathlib.Path):
+    """copy newfile to target unless target already has the same contents & mode"""
+    source_stat = newfile.stat()
+    if target.is_file():
+        target_stat = target.stat()
+        if (
+            target_stat.st_size == source_stat.st_size
+            and stat.S_IMODE(target_stat.st_mode) == stat.S_IMODE(source_stat.st_mode)
+            and hashlib.blake2b(target.read_bytes()).digest() == digest
+        ):
+            return False
+    # copies permission bits too, so e.g. executable scripts stay executable
+    shutil.copy(newfile, target)
+    return True
+
+
 @app.command()
 def update_file(assignment_name: str, newfile: pathlib.Path, filepath: str):
     """update a file in each student repo"""
+    from concurrent.futures import ThreadPoolExecutor
+
     dirs = _get_local_dirs(assignment_name)
+    digest = hashlib.blake2b(newfile.read_bytes()).digest()
+    targets = [path / filepath for path in dirs]
     print("copying", newfile, "to:")
-    for path in dirs:
-        print("    ", path / filepath)
-        if not newfile.samefile(path / filepath):
-            shutil.copy(newfile, path / filepath)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        copied = executor.map(lambda t: _copy_if_changed(newfile, digest, t), targets)
+        for target, changed in zip(targets, copied):
+            print("    ", target, *([] if changed else ["[dim](unchanged)"]))
 
 
 @app.command()
@@ -254,7 +498,7 @@ def configure(reset: bool = False):
     config_path: pathlib.Path = app_dir / "config.json"
     if config_path.is_file() and not reset:
         print(f"[red]{config_path} already exists, pass --reset to overwrite")
-        exit(1)
+        raise typer.Exit(code=1)
 
     default_working_dir = f"~/{APP_NAME}-workdir"
     working_dir = typer.prompt("Working directory", default=default_working_dir)